@@ -26,8 +26,6 @@ class UpdateAction(Action):
         return "update"
 
     def additional_fields(self):
-        d = {}
-        for key in self.member.dirty_fields():
-            d[key] = self.member.get(key)
-        return d
+        member = self.member
+        return {key: member.get(key) for key in member.dirty_fields()}
 
@@ -2,84 +2,211 @@
 Connections to ActionNetwork and AirTable.
 """
 
-from math import sin, cos, sqrt, atan2, radians
+import errno
+import itertools
 import os
+import pickle
 import requests
+import threading
 import time
 import timeago
 import hashlib
 import json
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from multiprocessing.pool import ThreadPool
 
 from records import HashFriendlyMember
 from actions import CreateAction, UpdateAction, DeleteAction
 
+class RateLimiter(object):
+    """ Spaces requests at least 1/per_second apart, across threads.
+        Only blocks when requests arrive faster than that. """
+    def __init__(self, per_second):
+        self._interval = 1.0 / per_second
+        self._next_allowed = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_allowed)
+            self._next_allowed = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+class RequestRejected(RuntimeError):
+    """ The server refused the request outright (a 4xx other than 429),
+        so none of it was applied and it is safe to send again in parts """
+
 class Connection(object):
+    cache_directory = 'cache'
+    requests_per_second = 5 # AirTable's documented limit
+    timeout = 30 # seconds
+    members_cache_version = 2 # bump whenever Member's stored attributes change
+
     def __init__(self, verbose):
         self.verbose = verbose
-
-    def _request_helper(self, href, params, headers, action=requests.get, data=None):
-        kwargs = {'params': params, 'headers': headers}
-        if data is not None:
-            kwargs['data'] = json.dumps(data)
-            kwargs['headers']['Content-Type'] = 'application/json'
-
-        try_count = 0
-        while try_count < 3:
-            try:
-                response = action(href, **kwargs)
-
-                if response.status_code != 200:
-                    raise RuntimeError("Server error %d: %s\n%s" % 
-                          (response.status_code, response.text, href))
-
-                return response.json()
-            except requests.exceptions.RequestException as e:
-                try_count += 1
-        raise RuntimeError("Server errored thrice for URL %s:\n>> %s" %
-                           (href, e.message))
-
-    def post_request(self, href, params, headers, data):
-        return self._request_helper(href, params, headers, requests.post, data)
-
-    def put_request(self, href, params, headers, data):
-        return self._request_helper(href, params, headers, requests.put, data)
-
-    def patch_request(self, href, params, headers, data):
-        return self._request_helper(href, params, headers, requests.patch, data)
-
-    def get_request(self, href, params, headers):
-        return self._request_helper(href, params, headers, requests.get)
-
-    def delete_request(self, href, params, headers):
-        return self._request_helper(href, params, headers, requests.delete)
-
-    def make_request(self, href, params, headers, cache_filename=None):
-        """ set cache_filename to enable caching of this result """
-        if cache_filename is None or not os.path.exists(cache_filename):
-            if self.verbose:
-                print("Requesting " + href)
-            json_response = self.get_request(href,
-                                            params = params,
-                                            headers = headers)
-            time.sleep(0.2) # Respect AirTable rate limiting rules
-            if cache_filename:
-                cache_directory = os.path.dirname(cache_filename)
-                if not os.path.exists(cache_directory):
-                    os.makedirs(cache_directory)
-                with open(cache_filename, 'w') as cached_json_fp:
-                    json.dump(json_response, cached_json_fp,
-                              sort_keys=True, indent=4)
-        else:
-            timestamp = os.path.getctime(cache_filename)
-            ago = timeago.format(timestamp)
-            if self.verbose:
-                print("Loading %s from cache downloaded %s" % \
-                      (cache_filename, ago))
+        self.rate_limiter = RateLimiter(self.requests_per_second)
+        self._cached_pages = [] # cache files read since the last member save
+        self._cache_directory_ready = False
+
+        # Reuse TCP/TLS connections across requests; retries with backoff
+        # are handled by urllib3 rather than by hand. A 429 is retried
+        # after the server's Retry-After. Non-idempotent requests are
+        # only retried when the connection could not be made, so a
+        # create is never sent twice.
+        retry = Retry(total=3,
+                      backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=16,
+                              pool_maxsize=32,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _response_helper(self, href, params, method, data=None):
+        # Auth headers live on the session; requests encodes json= bodies
+        # and sets Content-Type itself
+        kwargs = {'params': params, 'json': data, 'timeout': self.timeout}
+
+        self.rate_limiter.wait()
+        try:
+            response = self.session.request(method, href, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError("%s %s failed:\n>> %s" % (method, href, e))
+
+        if response.status_code != 200:
+            error = "Server error %d: %s\n%s" % \
+                    (response.status_code, response.text, href)
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                raise RequestRejected(error)
+            raise RuntimeError(error)
+
+        return response
+
+    def _request_helper(self, href, params, method, data=None):
+        return self._response_helper(href, params, method, data).json()
+
+    def post_request(self, href, params, data):
+        return self._request_helper(href, params, 'POST', data)
+
+    def put_request(self, href, params, data):
+        return self._request_helper(href, params, 'PUT', data)
+
+    def patch_request(self, href, params, data):
+        return self._request_helper(href, params, 'PATCH', data)
+
+    def get_request(self, href, params):
+        return self._request_helper(href, params, 'GET')
+
+    def delete_request(self, href, params):
+        return self._request_helper(href, params, 'DELETE')
+
+    def _make_cache_directory(self):
+        """ Makes sure the cache directory exists, checking only once per
+            connection. Called before writing to the cache, so connections
+            that never cache (do_actions.py, tests) don't create it. """
+        if self._cache_directory_ready:
+            return
+        try:
+            os.makedirs(self.cache_directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._cache_directory_ready = True
+
+    def _cache_filename(self, href, params):
+        """ Cache entries are keyed by a digest of the full request URL,
+            so callers needn't invent (and keep unique) their own names """
+        url = requests.Request('GET', href, params=params).prepare().url
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_directory, digest + '.json')
+
+    def _load_cached_page(self, href, cache_filename):
+        """ Returns the cached JSON, or None if this page isn't cached """
+        try:
             with open(cache_filename, 'r') as cached_json_fp:
                 json_response = json.load(cached_json_fp)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        if self.verbose:
+            ago = timeago.format(os.path.getctime(cache_filename))
+            print("Loading %s from cache downloaded %s" % (href, ago))
+        return json_response
 
+    def make_request(self, href, params, use_cache=False):
+        """ set use_cache to enable caching of this result """
+        cache_filename = None
+        if use_cache:
+            cache_filename = self._cache_filename(href, params)
+            self._cached_pages.append(cache_filename)
+            json_response = self._load_cached_page(href, cache_filename)
+            if json_response is not None:
+                return json_response
+
+        if self.verbose:
+            print("Requesting " + href)
+        response = self._response_helper(href, params, 'GET')
+        # Parse before caching, so a body that isn't JSON never gets cached
+        json_response = response.json()
+        if cache_filename:
+            # Store the body exactly as received rather than
+            # re-serializing the parsed response
+            self._make_cache_directory()
+            with open(cache_filename, 'wb') as cached_json_fp:
+                cached_json_fp.write(response.content)
         return json_response
 
+    def _members_cache_filename(self):
+        digest = hashlib.sha1(self.href.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_directory, digest + '.members.pickle')
+
+    def _load_members_cache(self):
+        """ Returns what _save_members_cache stored, unless any cached page
+            it was parsed from has since been removed or re-downloaded """
+        filename = self._members_cache_filename()
+        if not os.path.exists(filename):
+            return None
+
+        # A cache that can't be read back (truncated, or from an older
+        # Member layout) is just a miss; it'll be rebuilt from the pages
+        try:
+            with open(filename, 'rb') as fp:
+                version, page_filenames, data = pickle.load(fp)
+        except Exception:
+            return None
+        if version != self.members_cache_version:
+            return None
+
+        saved_at = os.path.getmtime(filename)
+        for page_filename in page_filenames:
+            if not os.path.exists(page_filename) or \
+               os.path.getmtime(page_filename) > saved_at:
+                return None
+
+        if self.verbose:
+            print("Loading members of %s from cache" % self.href)
+        return data
+
+    def _save_members_cache(self, data):
+        """ Saves data parsed from the pages requested since the last save,
+            so the next run can skip parsing them again """
+        self._make_cache_directory()
+        filename = self._members_cache_filename()
+        # Write aside and rename, so an interrupted save leaves no partial file
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as fp:
+            pickle.dump((self.members_cache_version, self._cached_pages, data),
+                        fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, filename)
+        self._cached_pages = []
+
     # Each connection must know how to do any action
     def do_action(self, action):
         """ Create actions return the Member that was created.
@@ -92,14 +219,49 @@ class Connection(object):
             return self._do_action_delete(action)
         else: assert False
 
+    def _announce(self, action):
+        print("Doing action:")
+        print("    %s" % (action.serialize(),))
+
+    def _try_action(self, action):
+        """ Does one action, warning about (rather than stopping on) failure """
+        try:
+            self.do_action(action)
+        except RuntimeError as e:
+            print("Warning: %s of %s failed: %s" %
+                  (action.action_name(), action.member.unique_id, e))
+
+    def do_actions(self, actions):
+        """ Does every action, warning about (rather than stopping on)
+            any that fail. Connections whose API can write several
+            records per request override this to batch them. """
+        for action in actions:
+            self._announce(action)
+            self._try_action(action)
+
     def _do_action_create(self, action): assert False
     def _do_action_update(self, action): assert False
     def _do_action_update(self, action): assert False
 
+def _has_livestream(member_json):
+    return member_json['custom_fields'].get('livestream 4/17') == 'yes'
+
+def _is_unsubscribed(member_json):
+    return member_json['email_addresses'][0]['status'] != 'subscribed'
+
 class ANConnection(Connection):
+    requests_per_second = 4 # ActionNetwork's documented limit
+    page_workers = 8
+
+    # (Member field, ActionNetwork key, how AN nests the value)
+    field_map = (('last_name',     'family_name',      lambda v: v),
+                 ('first_name',    'given_name',       lambda v: v),
+                 ('zip_code',      'postal_addresses', lambda v: [{'postal_code': v}]),
+                 ('email_address', 'email_addresses',  lambda v: [{'address': v}]))
+
     def __init__(self, an_token, verbose):
         super(ANConnection, self).__init__(verbose)
-        self.headers = {'OSDI-API-Token': an_token}
+        self.session.headers['OSDI-API-Token'] = an_token
         self.params = {}
         self.href = 'https://actionnetwork.org/api/v2/people'
 
@@ -119,76 +281,94 @@ class ANConnection(Connection):
             only returns JSON fields for non-null fields, which
             allows for creation of partial dictionaries for updates """
         p = {}
-        if member.get('last_name') is not None:
-            p['family_name'] = member.get('last_name')
-
-        if member.get('first_name') is not None:
-            p['given_name'] = member.get('first_name')
-
-        if member.get('zip_code') is not None:
-            p['postal_addresses'] = [{'postal_code': member.get('zip_code')}]
-
-        if member.get('email_address') is not None:
-            p['email_addresses'] = [{'address': member.get('email_address')}]
-
+        for ours, theirs, wrap in self.field_map:
+            value = member.get(ours)
+            if value is not None:
+                p[theirs] = wrap(value)
         return p
 
-    def _sieve_of_inimportance(self, members_json):
-        def has_livestream(member):
-            if 'livestream 4/17' in member['custom_fields']:
-                if member['custom_fields']['livestream 4/17'] == 'yes':
-                    return True
-            return False
-        def is_unsubscribed(member):
-            if member['email_addresses'][0]['status'] != 'subscribed':
-                return True
-            return False
+    def _is_unimportant(self, member_json):
+        return _has_livestream(member_json) or _is_unsubscribed(member_json)
 
+    def _create_members_from(self, an_json):
+        """ Sieves and converts each person in a single pass, without
+            building intermediate lists of the raw JSON """
         keep_members = []
         toss_members = []
-        for m in members_json:
-            if not has_livestream(m) and not is_unsubscribed(m):
-                keep_members.append(m)
+        for member_json in an_json['_embedded']['osdi:people']:
+            member = self._json_to_member(member_json)
+            if self._is_unimportant(member_json):
+                toss_members.append(member)
             else:
-                toss_members.append(m)
+                keep_members.append(member)
         return keep_members, toss_members
 
-    def _create_members_from(self, an_json):
-        members_json = an_json['_embedded']['osdi:people']
-        keep_json, toss_json = self._sieve_of_inimportance(members_json)
-        keep_members = [self._json_to_member(x) for x in keep_json]
-        toss_members = [self._json_to_member(x) for x in toss_json]
-        return keep_members, toss_members
+    def _request_page(self, page):
+        return self.make_request(
+            href = self.href,
+            params = dict(self.params, page=page),
+            use_cache = True)
+
+    def _pages_following(self, an_json):
+        """ Follows the next links one page at a time, for when we can't
+            know up front how many pages there are """
+        for _ in range(500): # safety check
+            next_link = an_json['_links'].get('next')
+            if next_link is None:
+                return
+            an_json = self.make_request(
+                href = next_link['href'],
+                params = self.params,
+                use_cache = True)
+            yield an_json
+        raise RuntimeError("Runaway pagination at %s" % self.href)
 
     def create_members(self):
+        """ The first page usually tells us how many pages there are, so the
+            rest are fetched concurrently (still subject to the rate limiter) """
+        cached = self._load_members_cache()
+        if cached is not None:
+            keeps, self.tossed_members = cached
+            return keeps
+
+        first_page = self._request_page(1)
+        total_pages = first_page.get('total_pages')
+        pool = None
+        if total_pages is None:
+            rest = self._pages_following(first_page)
+        else:
+            if total_pages > 500: # safety check
+                raise RuntimeError("Runaway pagination at %s" % self.href)
+            pool = ThreadPool(self.page_workers)
+            rest = pool.imap(self._request_page, range(2, total_pages + 1))
+
         keeps = []
         tosses = []
-        page = 0
-        href = self.href
-        while True:
-            an_json = self.make_request(
-                href = href,
-                params = self.params,
-                headers = self.headers,
-                cache_filename = 'cache/an_cache_%s.json' % page)
-            keep, toss = self._create_members_from(an_json)
-            keeps.extend(keep)
-            tosses.extend(toss)
-
-            href = an_json
-            if 'next' not in an_json['_links']:
-                self.tossed_members = tosses
-                return keeps
-
-            href = an_json['_links']['next']['href']
-            page += 1
-            assert page < 500 # safety check
+        fetched_all = False
+        try:
+            for an_json in itertools.chain([first_page], rest):
+                keep, toss = self._create_members_from(an_json)
+                keeps.extend(keep)
+                tosses.extend(toss)
+            fetched_all = True
+        finally:
+            if pool is not None:
+                if fetched_all:
+                    pool.close()
+                    pool.join()
+                else:
+                    # Drop the queued pages; requests already in flight
+                    # finish on their own rather than holding up the error
+                    pool.terminate()
+
+        self._save_members_cache((keeps, tosses))
+        self.tossed_members = tosses
+        return keeps
 
     def _do_action_create(self, action):
         formatted_member = self._member_to_json(action.member)
         data = self.post_request(href = self.href,
                                  params = self.params,
-                                 headers = self.headers,
                                  data = formatted_member)
         return self._json_to_member(data)
 
@@ -196,7 +376,7 @@ class ANConnection(Connection):
         # Construct URL as per
         # https://actionnetwork.org/docs/v2/queries
         prefix = 'action_network:'
-        if prefix not in action.member.unique_id:
+        if not action.member.unique_id.startswith(prefix):
             print "Warning! This member has a funny prefix. Not deleting", action.member
             return
         unique_id = action.member.unique_id[len(prefix):]
@@ -204,7 +384,6 @@ class ANConnection(Connection):
 
         self.put_request(href = href,
                          params = self.params,
-                         headers = self.headers,
                          data = data)
 
     def _do_action_update(self, action):
@@ -230,9 +409,16 @@ class ATConnection(Connection):
                          'Last Name',
                          'Zip code')
 
+    # (Member field, AirTable field), in the order of fields_to_request
+    field_map = tuple(zip(('email_address', 'first_name', 'last_name', 'zip_code'),
+                          fields_to_request))
+
+    # AirTable accepts at most this many records per create/update/delete
+    batch_size = 10
+
     def __init__(self, at_token, verbose):
         super(ATConnection, self).__init__(verbose)
-        self.headers = {'Authorization': 'Bearer %s' % at_token}
+        self.session.headers['Authorization'] = 'Bearer %s' % at_token
         self.params = {'fields': self.fields_to_request}
         self.href = 'https://api.airtable.com/v0/appKBM2llidtAm4kw/'\
                     'Community%20Members'
@@ -256,12 +442,10 @@ class ATConnection(Connection):
             only returns JSON fields for non-null fields, which
             allows for creation of partial dictionaries for updates """
         p = {}
-
-        conversion = ['email_address', 'first_name', 'last_name', 'zip_code']
-        for (ours, theirs) in zip(conversion, self.fields_to_request):
-            if member.get(ours) is not None:
-                p[theirs] = member.get(ours)
-
+        for ours, theirs in self.field_map:
+            value = member.get(ours)
+            if value is not None:
+                p[theirs] = value
         return {'fields': p}
 
     def _create_members_from(self, at_json):
@@ -269,6 +453,10 @@ class ATConnection(Connection):
         return [self._json_to_member(x) for x in members_json]
 
     def create_members(self):
+        members = self._load_members_cache()
+        if members is not None:
+            return members
+
         members = []
         page = 0
         params = dict(self.params) # make a copy
@@ -276,16 +464,17 @@ class ATConnection(Connection):
             at_json = self.make_request(
                               href = self.href,
                               params = params,
-                              headers = self.headers,
-                              cache_filename = 'cache/at_cache_%s.json' % page)
+                              use_cache = True)
             members.extend(self._create_members_from(at_json))
 
             if 'offset' not in at_json:
+                self._save_members_cache(members)
                 return members
 
             params['offset'] = at_json['offset']
             page += 1
-            assert page < 500 # safety check
+            if page >= 500: # safety check
+                raise RuntimeError("Runaway pagination at %s" % self.href)
 
     def _href_for_member(self, member):
         return self.href + '/' + member.unique_id
@@ -294,7 +483,6 @@ class ATConnection(Connection):
         formatted_member = self._member_to_json(action.member)
         data = self.post_request(href = self.href,
                                  params = self.params,
-                                 headers = self.headers,
                                  data = formatted_member)
         return self._json_to_member(data)
 
@@ -303,11 +491,61 @@ class ATConnection(Connection):
         href = self._href_for_member(action.member)
         data = self.patch_request(href = href,
                                   params = self.params,
-                                  headers = self.headers,
                                   data = formatted_member)
 
     def _do_action_delete(self, action):
         href = self._href_for_member(action.member)
         data = self.delete_request(href = href,
-                                   params = self.params,
-                                   headers = self.headers)
+                                   params = self.params)
+
+    def _batches(self, actions):
+        for i in range(0, len(actions), self.batch_size):
+            yield actions[i:i+self.batch_size]
+
+    def _batch_ids(self, actions):
+        return ', '.join(str(a.member.unique_id) for a in actions)
+
+    def _do_batch_create(self, actions):
+        records = [self._member_to_json(a.member) for a in actions]
+        self.post_request(href = self.href,
+                          params = self.params,
+                          data = {'records': records})
+
+    def _do_batch_update(self, actions):
+        records = [dict(self._member_to_json(a.member), id=a.member.unique_id)
+                   for a in actions]
+        self.patch_request(href = self.href,
+                           params = self.params,
+                           data = {'records': records})
+
+    def _do_batch_delete(self, actions):
+        params = {'records[]': [a.member.unique_id for a in actions]}
+        self.delete_request(href = self.href,
+                            params = params)
+
+    def do_actions(self, actions):
+        """ Sends each run of neighbouring actions of the same type in
+            batches of batch_size records per request, keeping the actions
+            in their given order. AirTable rejects a whole batch
+            if any record in it is bad, so a rejected batch is retried one
+            record at a time to find the bad ones and still do the rest.
+            Any other failure (a timeout, a 5xx) may have happened after
+            AirTable applied the batch, so it is reported, never resent. """
+        batchers = {CreateAction: self._do_batch_create,
+                    UpdateAction: self._do_batch_update,
+                    DeleteAction: self._do_batch_delete}
+        for action_type, run in itertools.groupby(actions, type):
+            do_batch = batchers[action_type]
+            for batch in self._batches(list(run)):
+                for action in batch:
+                    self._announce(action)
+                try:
+                    do_batch(batch)
+                except RequestRejected as e:
+                    print("Warning: batch of %s was rejected, retrying one at a time: %s" %
+                          (self._batch_ids(batch), e))
+                    for action in batch:
+                        self._try_action(action)
+                except RuntimeError as e:
+                    print("Warning: batch of %s failed and was not retried: %s" %
+                          (self._batch_ids(batch), e))
@@ -1,21 +1,21 @@
 import argparse
+import itertools
 import pickle
 
 from connections import ANConnection, ATConnection
 
 def do_actions(actions, an_connection, at_connection):
+    connections = {"AirTable": at_connection,
+                   "ActionNetwork": an_connection}
     for action in actions:
-        print "Doing action:"
-        print "   ", action.serialize()
+        assert action.member.source_name in connections
 
-        try:
-            if action.member.source_name == "AirTable":
-                at_connection.do_action(action)
-            elif action.member.source_name == "ActionNetwork":
-                an_connection.do_action(action)
-            else: assert False
-        except RuntimeError as e:
-            print("Warning: runtime error", e)
+    # Actions run in their stored order; only neighbouring actions for the
+    # same database are handed over together, so they can be batched.
+    # Each connection prints every action as it sends it.
+    for source_name, run in itertools.groupby(
+            actions, lambda a: a.member.source_name):
+        connections[source_name].do_actions(list(run))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -36,7 +36,12 @@ if __name__ == "__main__":
     an_connection = ANConnection(an_token, False)
     at_connection = ATConnection(at_token, False)
 
-    with open(actions_filename, 'r') as f:
-        actions = pickle.load(f)
+    with open(actions_filename, 'rb') as f:
+        try:
+            actions = pickle.load(f)
+        except Exception as e:
+            raise SystemExit("Could not load %s (%s). If it was written by an "
+                             "older version, regenerate it with "
+                             "ib_database_sync.py." % (actions_filename, e))
 
     do_actions(actions, an_connection, at_connection)
@@ -4,10 +4,10 @@ and ActionNetwork databases.
 """
 
 import argparse
+from collections import Counter, defaultdict
 import json
 import os
 import re
-import shutil
 from tqdm import tqdm
 import pickle
 
@@ -15,6 +15,11 @@ from actions import CreateAction, UpdateAction, DeleteAction
 from connections import ANConnection, ATConnection
 from records import Member
 
+# Field sets that identify the same person in both databases. Tuples, so
+# members can memoize their hash_with keys without copying them.
+EQUIVALENCE_LAST_FIRST = ('last_name', 'first_name')
+EQUIVALENCE_EMAIL = ('email_address',)
+
 def msg(s="", end='\n'):
     tqdm.write(s, end=end)
 
@@ -22,15 +27,18 @@ class Prompter(object):
     def __init__(self, title):
         self._title = title
         self._options = []
-        self._members = []
+        self._option_keys = set()
+        self._member_by_key = {}
 
     def add_option(self, key, description):
-        self._options.append((str(key), description))
+        key = str(key)
+        self._options.append((key, description))
+        self._option_keys.add(key)
 
     def _add_member_helper(self, member, desc):
-        member_i = 1 + len(self._members)
-        self.add_option(member_i, desc)
-        self._members.append(member)
+        key = str(1 + len(self._member_by_key))
+        self.add_option(key, desc)
+        self._member_by_key[key] = member
 
     def add_next(self):
         self.add_option('n', 'next conflict (skip)')
@@ -47,37 +55,37 @@ class Prompter(object):
         self._add_member_helper(member, desc)
 
     def prompt(self):
+        # The options don't change between attempts, so show them once
         msg(self._title)
         for key, description in self._options:
             msg("[%s] %s" % (key, description))
 
-        try:
-            msg('choose option $> ', end='')
-            option = raw_input()
-        except KeyboardInterrupt:
-            if 'q' in [key for key,_ in self._options]:
-                return 'q'
-            else:
-                raise
-        msg()
-
-        try:
-            i = int(option)
-            if i >= 1 and i <= len(self._members):
-                return self._members[i-1]
-        except ValueError:
-            pass
+        while True:
+            try:
+                msg('choose option $> ', end='')
+                option = raw_input()
+            except KeyboardInterrupt:
+                if 'q' in self._option_keys:
+                    return 'q'
+                else:
+                    raise
+            msg()
 
-        if option in [key for key,_ in self._options]:
-            return option
+            # Accept " 1" or "01" for member 1, as int() parsing used to
+            option = option.strip()
+            if option.isdigit():
+                option = str(int(option))
+            if option in self._member_by_key:
+                return self._member_by_key[option]
+            if option in self._option_keys:
+                return option
 
-        msg("Invalid choice")
-        return self.prompt()
+            msg("Invalid choice")
 
 class MergeConflict(object):
-    def __init__(self, members, resolvers):
+    def __init__(self, members, resolvers=None):
         self.members = members
-        self.resolvers = resolvers
+        self.resolvers = DEFAULT_RESOLVERS if resolvers is None else resolvers
 
     def resolve(self):
         for member in self.members:
@@ -101,8 +109,8 @@ class ConflictResolver(object):
     def resolve(self, conflict): assert False # override this
 
     def is_any_conflict(self, members, field):
-        values = [m.get(field) for m in members]
-        return not all([v == values[0] for v in values])
+        first = members[0].get(field)
+        return any(m.get(field) != first for m in members[1:])
 
 class MissingFieldResolver(ConflictResolver):
     def resolve(self, members, equality_fields):
@@ -111,16 +119,23 @@ class MissingFieldResolver(ConflictResolver):
             if not self.is_any_conflict(members, field):
                 continue
 
-            values = [m.get(field) for m in members]
-            is_none  = [v for v in values if v is None]
-            not_none = [v for v in values if v is not None]
-            if len(not_none) > 1:
+            # Find the only non-None value, stopping as soon as there's a second
+            real_value = None
+            not_none_count = 0
+            for member in members:
+                value = member.get(field)
+                if value is not None:
+                    not_none_count += 1
+                    if not_none_count > 1:
+                        break
+                    real_value = value
+
+            if not_none_count > 1:
                 # Conflicting values - cannot resolve simply
                 all_conflicts_resolved = False
                 continue
 
-            assert len(not_none) == 1
-            real_value = not_none[0]
+            assert not_none_count == 1
 
             if real_value == "":
                 # Empty string is not useful - cannot resolve simply
@@ -135,14 +150,14 @@ class MissingFieldResolver(ConflictResolver):
             msg()
         return all_conflicts_resolved
 
+# Compiled once and shared by every ZipCodeResolver
+_PRECISE_ZIP = re.compile(r'^\d{5}\-\d{4}$')
+_ANY_ZIP = re.compile(r'^\d{5}$')
+
 class ZipCodeResolver(ConflictResolver):
     """ Resolves any zip code differences by picking the most precise zip
         available (12345-6789 format first, 12345 second).
         If there are multiple zips, chooses one randomly."""
-    def __init__(self):
-        self.precise_zip = re.compile(r'^\d{5}\-\d{4}$')
-        self.any_zip = re.compile(r'^\d{5}$')
-
     def resolve(self, members, equality_fields):
         if 'zip_code' not in equality_fields:
             return False
@@ -152,15 +167,19 @@ class ZipCodeResolver(ConflictResolver):
             if self.is_any_conflict(members, field):
                 return False
 
-        zips = [member.zip_code for member in members]
-        zips = ["" if z is None else z for z in zips]
-        is_precise_zip = [z is not None and self.precise_zip.match(z) is not None for z in zips]
-        is_okay_zip    = [z is not None and self.any_zip.match(z)     is not None for z in zips]
-        if(any(is_precise_zip)):
-            chosen_zip = zips[is_precise_zip.index(True)]
-        elif(any(is_okay_zip)):
-            chosen_zip = zips[is_okay_zip.index(True)]
-        else:
+        # One pass: stop at the first precise zip, remembering the first
+        # five-digit zip in case no precise one turns up
+        chosen_zip = None
+        for member in members:
+            z = member.zip_code
+            if not z:
+                continue
+            if _PRECISE_ZIP.match(z):
+                chosen_zip = z
+                break
+            if chosen_zip is None and _ANY_ZIP.match(z):
+                chosen_zip = z
+        if chosen_zip is None:
             return False
 
         for m in members:
@@ -225,19 +244,34 @@ class ManualResolver(ConflictResolver):
             self.set_every_field_to(equality_fields, members, option)
             return True
 
-def hash_members(members, equivalence_fields):
-    d = {}
+# The resolvers hold no per-conflict state, so every conflict shares these
+DEFAULT_RESOLVERS = (MissingFieldResolver(), ZipCodeResolver(), ManualResolver())
+
+def hash_members_multi(members, all_equivalence_fields, skip_dirty=False):
+    """ Buckets members by each of several equivalence field sets,
+        visiting every member only once """
+    dicts = [defaultdict(list) for _ in all_equivalence_fields]
     for m in members:
-        key = m.hash_with(equivalence_fields)
-        if key not in d:
-            d[key] = []
-        if key in d:
-            d[key].append(m)
-    return d
+        if skip_dirty and m.dirty:
+            continue
+        for d, equivalence_fields in zip(dicts, all_equivalence_fields):
+            d[m.hash_with(equivalence_fields)].append(m)
+    return dicts
+
+def hash_members(members, equivalence_fields):
+    return hash_members_multi(members, [equivalence_fields])[0]
 
 def find_duplicates(members, equivalence_fields):
-    hm = hash_members(members, equivalence_fields)
-    return [hm[key] for key in hm if len(hm[key]) > 1]
+    """ Buckets members in one pass, noting each bucket as soon as it gets
+        its second member rather than scanning every bucket afterwards """
+    buckets = defaultdict(list)
+    duplicates = []
+    for m in members:
+        bucket = buckets[m.hash_with(equivalence_fields)]
+        bucket.append(m)
+        if len(bucket) == 2:
+            duplicates.append(bucket)
+    return duplicates
 
 def resolve_duplicates(duplicates):
     actions = []
@@ -259,78 +293,62 @@ def resolve_duplicates(duplicates):
     return actions
 
 def print_duplicates_within(dups):
+    lines = []
     for dup_list in dups:
-        for member in dup_list:
-            msg(member.prettystring())
-        msg()
-
-def find_duplicates_across(an_members, at_members, an_tossed, equivalence_fields):
-    # Collisions in all_fields means that the two members are exact copies
-    an_dict_all_fields  = hash_members(an_members, None)
-    at_dict_all_fields  = hash_members(at_members, None)
-
+        lines.extend(member.prettystring() for member in dup_list)
+        lines.append("")
+    if lines:
+        msg("\n".join(lines))
+
+def find_duplicates_across(an_members, at_members, an_tossed, equivalence_fields,
+                           skip_dirty=False):
+    # Collisions in all_fields means that the two members are exact copies.
     # Collisions in equality_fields means that the two members share equivalence_fields
     # but may (or may not) share other data.
-    an_dict_equality_fields = hash_members(an_members, equivalence_fields)
-    at_dict_equality_fields = hash_members(at_members, equivalence_fields)
+    # With skip_dirty, members changed by an earlier resolution are left out.
+    an_dict_all_fields, an_dict_equality_fields = hash_members_multi(
+            an_members, [None, equivalence_fields], skip_dirty)
+    at_dict_all_fields, at_dict_equality_fields = hash_members_multi(
+            at_members, [None, equivalence_fields], skip_dirty)
     an_tossed_equality_fields = hash_members(an_tossed, equivalence_fields)
 
-    # all_members contains ??
-    all_members_keys = set(an_dict_all_fields.keys()+at_dict_all_fields.keys())
-    all_members = []
-    for key in all_members_keys:
-        if key in an_dict_all_fields:
-            all_members.append(an_dict_all_fields[key][0])
-        else:
-            all_members.append(at_dict_all_fields[key][0])
-
-
     merge_conflicts = []
     needs_sync = []
     up_to_date = []
 
-    resolvers = [MissingFieldResolver(), ZipCodeResolver(), ManualResolver()]
-
-    keys_already_processed = set()
-    for member in all_members:
+    # Walk each equivalence group once. The first member of a group stands
+    # in for it, preferring ActionNetwork's side when both have the group.
+    all_equality_keys = set(an_dict_equality_fields).union(at_dict_equality_fields)
+    for equality_key in all_equality_keys:
+        at_equality_members = at_dict_equality_fields.get(equality_key)
+        an_equality_members = an_dict_equality_fields.get(equality_key)
+        member = (an_equality_members or at_equality_members)[0]
         key_in_all = member.hash_with(None)
-        equality_key = member.hash_with(equivalence_fields)
-
-        # Each merge conflict will be several times, once by each member
-        # in the conflict. Prevent that.
-        if equality_key in keys_already_processed:
-            continue
-        keys_already_processed.add(equality_key)
 
         is_in_at_all = key_in_all in at_dict_all_fields
         is_in_an_all = key_in_all in an_dict_all_fields
-        is_in_at_equality = equality_key in at_dict_equality_fields
-        is_in_an_equality = equality_key in an_dict_equality_fields
-        is_in_an_tossed = equality_key in an_tossed_equality_fields
         assert is_in_at_all or is_in_an_all
-        assert is_in_at_equality or is_in_an_equality
 
         if not is_in_at_all or not is_in_an_all:
-            if is_in_at_equality and is_in_an_equality:
-                members_conflicted = an_dict_equality_fields[equality_key] +\
-                                     at_dict_equality_fields[equality_key]
-                conflict = MergeConflict(members_conflicted, resolvers)
+            if at_equality_members and an_equality_members:
+                members_conflicted = an_equality_members + at_equality_members
+                conflict = MergeConflict(members_conflicted)
                 merge_conflicts.append(conflict)
-            elif is_in_at_equality and not is_in_an_equality:
-                if not is_in_an_tossed:
+            elif at_equality_members:
+                if equality_key not in an_tossed_equality_fields:
                     needs_sync.append(member)
-            elif is_in_an_equality and not is_in_at_equality:
-                needs_sync.append(member)
             else:
-                assert False
+                needs_sync.append(member)
     return merge_conflicts, needs_sync, up_to_date
 
 def print_merge_conflicts(merge_conflicts):
+    lines = []
     for conflict in merge_conflicts:
         for member in conflict.members:
-            name = member.source_name
-            msg("%30s has:" % name, member.prettystring())
-        msg()
+            lines.append("%30s has: %s" % (member.source_name, member.prettystring()))
+        lines.append("")
+    if lines:
+        msg("\n".join(lines))
 
 def resolve_merge_conflicts(merge_conflicts):
     actions = []
@@ -344,15 +362,13 @@ def resolve_merge_conflicts(merge_conflicts):
             break
     return actions
 
+# A member missing from one database gets created in the other
+_SYNC_DESTINATION = {"AirTable": "ActionNetwork", "ActionNetwork": "AirTable"}
+
 def sync_actions(needs_sync):
     actions = []
     for member in needs_sync:
-        if member.source_name is "AirTable":
-            source = "ActionNetwork"
-        elif member.source_name is "ActionNetwork":
-            source = "AirTable"
-        else: assert False
-
+        source = _SYNC_DESTINATION[member.source_name]
         new_member = Member(first_name = member.first_name,
                             last_name = member.last_name,
                             email_address = member.email_address,
@@ -365,14 +381,17 @@ def sync_actions(needs_sync):
 
 def print_needs_sync(needs_sync, equivalence_fields,
                      at_dict_equality_fields, an_dict_equality_fields):
+    lines = []
     for member in needs_sync:
         key = member.hash_with(equivalence_fields)
         if key not in at_dict_equality_fields:
-            msg("     Airtable is missing member", member.prettystring())
+            lines.append("     Airtable is missing member " + member.prettystring())
         elif key not in an_dict_equality_fields:
-            msg("ActionNetwork is missing member", member.prettystring())
+            lines.append("ActionNetwork is missing member " + member.prettystring())
         else:
             assert False
+    if lines:
+        msg("\n".join(lines))
 
 def serialize_actions(actions, basename):
     def make_unique(filename):
@@ -381,20 +400,19 @@ def serialize_actions(actions, basename):
             backup_filename_fmt = filename + "_%d"
             while os.path.exists(backup_filename_fmt % i):
                 i += 1
-            shutil.copy2(filename, backup_filename_fmt % i)
+            os.rename(filename, backup_filename_fmt % i)
         return filename
 
     # Simple serialization
     json_filename = basename + ".json"
     make_unique(json_filename)
-    d = [action.serialize() for action in actions]
     with open(json_filename, 'w') as f:
-        json.dump(d, f, indent=4)
+        json.dump([action.serialize() for action in actions], f, indent=4)
 
     pickle_filename = basename + ".pickle"
     make_unique(pickle_filename)
-    with open(pickle_filename, 'w') as f:
-        pickle.dump(actions, f)
+    with open(pickle_filename, 'wb') as f:
+        pickle.dump(actions, f, pickle.HIGHEST_PROTOCOL)
 
 def get_merge_info(an_members, at_members, an_tossed, equivalence_fields, verbose):
     an_dups = find_duplicates(an_members, equivalence_fields)
@@ -414,10 +432,9 @@ def get_merge_info(an_members, at_members, an_tossed, equivalence_fields, verbos
         actions.extend(resolve_duplicates(at_dups))
 
         # Merge conflicts depend on how the above was resolved. Don't look at dirty members.
-        an_members_clean = [m for m in an_members if not m.dirty]
-        at_members_clean = [m for m in at_members if not m.dirty]
         merge_conflicts, needs_sync, up_to_date = find_duplicates_across(
-                    an_members_clean, at_members_clean, an_tossed, equivalence_fields)
+                    an_members, at_members, an_tossed, equivalence_fields,
+                    skip_dirty=True)
 
         sync_actions_ = sync_actions(needs_sync)
         actions.extend(sync_actions_)
@@ -426,9 +443,9 @@ def get_merge_info(an_members, at_members, an_tossed, equivalence_fields, verbos
         actions.extend(merge_actions)
 
         # Print out summary
-        def is_from(m, where): return m.source_name == where
-        sync_count_at = sum([is_from(m, "AirTable") for m in needs_sync])
-        sync_count_an = sum([is_from(m, "ActionNetwork") for m in needs_sync])
+        sync_counts = Counter(m.source_name for m in needs_sync)
+        sync_count_at = sync_counts["AirTable"]
+        sync_count_an = sync_counts["ActionNetwork"]
         msg("%d members created via sync, of which\n"
             "   %d originated from AirTable, and\n"
             "   %d originated from ActionNetwork" % \
@@ -469,8 +486,8 @@ if __name__ == "__main__":
             (numFiltered, len(an_members)+numFiltered))
 
     all_equivalence_fields = [
-                             #['last_name', 'first_name'],
-                              ['email_address']]
+                             #EQUIVALENCE_LAST_FIRST,
+                              EQUIVALENCE_EMAIL]
     for equivalence_fields in all_equivalence_fields:
         get_merge_info(an_members, at_members,
                        an_connection.tossed_members, equivalence_fields, verbose)
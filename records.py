@@ -4,6 +4,11 @@ along with helpers to make it hashable based on a subset of the fields
 """
 
 class Member(object):
+    # No per-instance __dict__; there are tens of thousands of these
+    __slots__ = ('_first_name', '_last_name', '_email_address', '_zip_code',
+                 '_unique_id', '_last_edit', '_source_name',
+                 '_dirty', '_original_dict', '_prettystring')
+
     def __init__(self, first_name, last_name, email_address,
                  zip_code, last_edit, source_name, unique_id):
         # Member data
@@ -18,6 +23,7 @@ class Member(object):
         self._source_name = source_name
         self._dirty = False
         self._original_dict = {} # what's dirty?
+        self._prettystring = None # cached until the next set()
 
     @property
     def first_name(self):
@@ -80,75 +86,111 @@ class Member(object):
         return self._dirty
 
     def get(self, field):
-        return self.__dict__["_"+field]
+        return getattr(self, "_"+field)
 
     def set(self, field, new_value):
         curr_value = self.get(field)
         if curr_value != new_value:
             self._dirty = True
             self._original_dict[field] = curr_value
-            self.__dict__["_"+field] = new_value
+            setattr(self, "_"+field, new_value)
+            self._prettystring = None
+
+    def __setstate__(self, state):
+        """ Accepts the (dict, slots) state pickled now, as well as the plain
+            __dict__ pickled before Member had __slots__, so actions files
+            written by older versions can still be replayed """
+        if isinstance(state, tuple):
+            legacy_dict, slots = state
+            state = dict(legacy_dict or {})
+            state.update(slots)
+        self._prettystring = None
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def prettystring(self):
-        return "%30s %60s - %10s" % \
-                (unicode(self.first_name) + " " + unicode(self.last_name),
-                 "<"+unicode(self.email_address)+">",
-                 self.zip_code)
+        if self._prettystring is None:
+            self._prettystring = "%30s %60s - %10s" % \
+                    (unicode(self.first_name) + " " + unicode(self.last_name),
+                     "<"+unicode(self.email_address)+">",
+                     self.zip_code)
+        return self._prettystring
 
     def dirty_fields(self):
         return self._original_dict.keys()
 
+def _clean(s):
+    """ convert to lower case and strip, treating blank strings as missing """
+    if not isinstance(s, basestring): return s
+    cleaned = s.lower().strip()
+    if cleaned == "": return None
+    return cleaned
+
 class HashFriendlyMember(Member):
     """ This class is sortable and hashable based on equality_fields.
         It will be considered equal to another HashFriendlyMember if all
         equality_fields are equal, ignoring the equality of other fields. """
+    __slots__ = ('_hash_cache',)
+    equality_fields = ('first_name', 'last_name', 'email_address', 'zip_code')
+    sort_order = ('last_name', 'first_name', 'email_address', 'zip_code')
+    # The sort_order fields that take part in equality
+    _sort_fields = tuple([field for field in sort_order if field in equality_fields])
+
     def __init__(self, *args, **kwargs):
         super(HashFriendlyMember, self).__init__(*args, **kwargs)
 
-        self.equality_fields = ['first_name', 'last_name', 'email_address', 'zip_code']
+        self._hash_cache = {} # hash_with results, by field set
+
+    def set(self, field, new_value):
+        super(HashFriendlyMember, self).set(field, new_value)
+        self._hash_cache.clear()
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled before __slots__, when each member had equality_fields
+            state = dict(state)
+            state.pop('equality_fields', None)
+        self._hash_cache = {}
+        super(HashFriendlyMember, self).__setstate__(state)
 
     def hash_with(self, only_these_fields=None):
         """ Gets a unique hash using only_these_fields. If left as the default
             None, uses all available fields. """
+        cache_key = only_these_fields
+        if cache_key is not None and not isinstance(cache_key, tuple):
+            cache_key = tuple(cache_key) # lists aren't hashable
+        try:
+            return self._hash_cache[cache_key]
+        except KeyError:
+            pass
+
         if only_these_fields is None:
-            only_these_fields = self.equality_fields
-        d = dict([(field, self.get_clean(field)) for field in only_these_fields])
-        return str(d)
+            key = tuple(_clean(self.get(field)) for field in self.equality_fields)
+        else:
+            key = tuple(self.get_clean(field) for field in only_these_fields)
+        self._hash_cache[cache_key] = key
+        return key
 
     def get_clean(self, field):
-        """ prepare a string for comparison: convert to lower case and strip """
-        s = self.get(field)
-        if not isinstance(s, basestring): return s
-        cleaned = s.lower().strip()
-        if cleaned == "": return None
-        return cleaned
-
-    def _is_eq(self, other, field):
-        this = self.get_clean(field)
-        that = other.get_clean(field)
-        if this == that: return True
-        if this is None or that is None: return False
-        return this == that
+        """ prepare a string for comparison: convert to lower case and strip.
+            Equality fields are read from the cached all-fields key. """
+        all_fields = self.equality_fields
+        if field in all_fields:
+            return self.hash_with(None)[all_fields.index(field)]
+        return _clean(self.get(field))
 
     def __eq__(self, other):
         if not isinstance(other, HashFriendlyMember):
             return False
-        return all([self._is_eq(other, field) for field in self.equality_fields])
+        return self.hash_with(None) == other.hash_with(None)
 
     def __str__(self):
-        d = dict([(field, self.get_clean(field)) for field in self.equality_fields])
-        return str(d)
+        # For display only; hashing and equality use hash_with directly
+        return str(dict(zip(self.equality_fields, self.hash_with(None))))
 
     def __lt__(self, other):
-        sort_order = ['last_name', 'first_name', 'email_address', 'zip_code']
-        equality_fields_sorted = sorted(self.equality_fields,
-                                        key=lambda x: sort_order.index(x))
-        for field in equality_fields_sorted:
-            if self._is_eq(other, field):
-                continue
-            else:
-                return self.get_clean(field) < self.get_clean(field)
-        return False
+        # Tuples compare field by field in sort_order, like a manual walk would
+        return self.hash_with(self._sort_fields) < other.hash_with(other._sort_fields)
 
     def __hash__(self):
-        return int(hashlib.md5(str(self)).hexdigest(), 16)
+        return hash(self.hash_with(None))
@@ -1,12 +1,19 @@
 import os
 import nose
+import shutil
+import tempfile
+import threading
+import time
 
 from contextlib import contextmanager
 
-from connections import ANConnection, ATConnection
+from connections import ANConnection, ATConnection, RateLimiter, RequestRejected
 from actions import CreateAction, DeleteAction, UpdateAction
-from records import Member
-from ib_database_sync import ZipCodeResolver
+from records import Member, HashFriendlyMember
+from do_actions import do_actions
+import ib_database_sync
+from ib_database_sync import ZipCodeResolver, MissingFieldResolver, Prompter, \
+                             find_duplicates, find_duplicates_across
 
 @contextmanager
 def assert_raises(exception_type):
@@ -64,8 +71,298 @@ def test_zip_resolver():
     member0.zip_code = None
     assert resolver.resolve([member0, member1], equality_fields)
 
-def _get_fake_member():
-    return Member(
+def test_rate_limiter():
+    limiter = RateLimiter(per_second=20)
+
+    # The first request goes straight through...
+    start = time.time()
+    limiter.wait()
+    assert time.time() - start < 0.05
+
+    # ...but back-to-back requests are spaced out
+    limiter.wait()
+    limiter.wait()
+    assert time.time() - start >= 0.1
+
+def test_members_cache():
+    connection = ATConnection("no-token", verbose=False)
+    connection.cache_directory = tempfile.mkdtemp()
+    try:
+        connection._save_members_cache(["a member"])
+        assert connection._load_members_cache() == ["a member"]
+
+        # A save from an older layout is a miss, not an error...
+        connection.members_cache_version -= 1
+        assert connection._load_members_cache() is None
+        connection.members_cache_version += 1
+
+        # ...and so is a save that was cut off partway
+        filename = connection._members_cache_filename()
+        with open(filename, 'r+b') as fp:
+            fp.truncate(5)
+        assert connection._load_members_cache() is None
+    finally:
+        shutil.rmtree(connection.cache_directory)
+
+def test_airtable_batching():
+    connection = ATConnection("no-token", verbose=False)
+    sent = []
+    def post_request(href, params, data): sent.append(('POST', href, data))
+    def patch_request(href, params, data): sent.append(('PATCH', href, data))
+    def delete_request(href, params): sent.append(('DELETE', href, params))
+    connection.post_request = post_request
+    connection.patch_request = patch_request
+    connection.delete_request = delete_request
+
+    def member(unique_id):
+        m = _get_fake_member(HashFriendlyMember)
+        m.unique_id = unique_id
+        return m
+    creates = [CreateAction(member(None)) for _ in range(12)]
+    updates = [UpdateAction(member("rec1"))]
+    deletes = [DeleteAction(member("rec2")), DeleteAction(member("rec3"))]
+    late_create = [CreateAction(member(None))]
+    connection.do_actions(deletes + creates + updates + late_create)
+
+    # Actions keep their order; neighbours of one type share requests of
+    # at most batch_size records
+    assert [(method, len(data['records'])) for method, _, data in sent[1:3]] == \
+           [('POST', 10), ('POST', 2)]
+    assert sent[0] == ('DELETE', connection.href, {'records[]': ['rec2', 'rec3']})
+    method, href, data = sent[3]
+    assert (method, href) == ('PATCH', connection.href)
+    assert data == {'records': [{'id': 'rec1',
+                                 'fields': {'Email Address': 'nonexistent@gmail.com',
+                                            'First Name': "Armin's",
+                                            'Last Name': 'Test',
+                                            'Zip code': '94704'}}]}
+    method, _, data = sent[4]
+    assert (method, len(data['records'])) == ('POST', 1)
+    assert len(sent) == 5
+
+def test_airtable_batch_failure():
+    connection = ATConnection("no-token", verbose=False)
+    patched = []
+    def patch_request(href, params, data):
+        # AirTable rejects the whole batch because of one bad record
+        if href == connection.href or href.endswith('/bad'):
+            raise RequestRejected("Server error 422")
+        patched.append(href)
+    connection.patch_request = patch_request
+
+    updates = []
+    for unique_id in ("good1", "bad", "good2"):
+        m = _get_fake_member(HashFriendlyMember)
+        m.unique_id = unique_id
+        updates.append(UpdateAction(m))
+    connection.do_actions(updates)
+
+    # The good records still went through, one at a time
+    assert patched == [connection.href + '/good1', connection.href + '/good2']
+
+def test_an_page_failure_stops_workers():
+    connection = ANConnection("no-token", verbose=False)
+    connection.page_workers = 2
+    connection._load_members_cache = lambda: None
+    fetched = []
+    blocked_workers = set()
+    release = threading.Event()
+    def request_page(page):
+        if page == 1:
+            return {'total_pages': 50, '_embedded': {'osdi:people': []}}
+        fetched.append(page)
+        if page == 3:
+            raise RuntimeError("Server error 500")
+        if page > 3:
+            # Hold every later page in flight until the error is out
+            blocked_workers.add(threading.current_thread())
+            release.wait()
+        return {'_embedded': {'osdi:people': []}}
+    connection._request_page = request_page
+
+    with assert_raises(RuntimeError):
+        connection.create_members()
+    release.set()
+    for worker in blocked_workers:
+        worker.join()
+
+    # Only pages already in flight, at most one per worker, were requested;
+    # the rest of the queue was dropped
+    assert max(fetched) <= 3 + connection.page_workers
+
+def test_an_follows_next_links():
+    connection = ANConnection("no-token", verbose=False)
+    connection._load_members_cache = lambda: None
+    connection._save_members_cache = lambda data: None
+    def page_json(next_href):
+        links = {'next': {'href': next_href}} if next_href else {}
+        return {'_links': links, '_embedded': {'osdi:people': []}}
+    # No total_pages, so the pages can only be walked in order
+    connection._request_page = lambda page: page_json("page-2")
+    requested = []
+    def make_request(href, params, use_cache=False):
+        requested.append(href)
+        return page_json("page-3" if href == "page-2" else None)
+    connection.make_request = make_request
+
+    assert connection.create_members() == []
+    assert requested == ["page-2", "page-3"]
+
+def test_airtable_batch_timeout():
+    connection = ATConnection("no-token", verbose=False)
+    posts = []
+    def post_request(href, params, data):
+        # AirTable may well have created these before the response was lost
+        posts.append(data)
+        raise RuntimeError("POST %s failed:\n>> Read timed out" % href)
+    connection.post_request = post_request
+
+    connection.do_actions([CreateAction(_get_fake_member(HashFriendlyMember))
+                           for _ in range(3)])
+
+    # So the creates are reported, not sent a second time
+    assert len(posts) == 1
+
+def test_do_actions_keeps_order():
+    class RecordingConnection(object):
+        def do_actions(self, actions):
+            runs.append((self, actions))
+    runs = []
+    an_connection = RecordingConnection()
+    at_connection = RecordingConnection()
+
+    def action(source_name):
+        m = _get_fake_member()
+        m.source_name = source_name
+        return DeleteAction(m)
+    actions = [action("AirTable"), action("AirTable"),
+               action("ActionNetwork"), action("AirTable")]
+    do_actions(actions, an_connection, at_connection)
+
+    assert [(c, len(a)) for c, a in runs] == \
+           [(at_connection, 2), (an_connection, 1), (at_connection, 1)]
+
+def test_member_hashing():
+    member0 = _get_fake_member(HashFriendlyMember)
+    member1 = _get_fake_member(HashFriendlyMember)
+    member1.email_address = "  NonExistent@gmail.com "
+    member1.source_name = "ActionNetwork"
+
+    # Equality and hashing ignore case, whitespace and metadata
+    assert member0 == member1
+    assert hash(member0) == hash(member1)
+    assert member0.hash_with(['email_address']) == \
+           member1.hash_with(['email_address'])
+
+    member1.last_name = "Different"
+    assert not member0 == member1
+    assert member1 < member0
+    assert not member0 < member1
+    assert member0.hash_with(None) != member1.hash_with(None)
+    assert member0.hash_with(['email_address']) == \
+           member1.hash_with(['email_address'])
+
+def test_legacy_member_state():
+    # The __dict__ of a member pickled before Member had __slots__
+    legacy_state = {'_first_name': 'Z', '_last_name': 'Test',
+                    '_email_address': 'a@b.com', '_zip_code': '94704',
+                    '_unique_id': 'rec1', '_last_edit': 0,
+                    '_source_name': 'AirTable', '_dirty': True,
+                    '_original_dict': {'first_name': 'A'},
+                    'equality_fields': ['first_name', 'last_name',
+                                        'email_address', 'zip_code']}
+    member = HashFriendlyMember.__new__(HashFriendlyMember)
+    member.__setstate__(legacy_state)
+    assert member.hash_with(None) == ('z', 'test', 'a@b.com', '94704')
+    assert member.dirty and member.dirty_fields() == ['first_name']
+    assert UpdateAction(member).serialize()['first_name'] == 'Z'
+
+def test_prompter_padded_input():
+    member0 = _get_fake_member()
+    member1 = _get_fake_member()
+    prompter = Prompter("Pick one")
+    prompter.add_member(member0)
+    prompter.add_member(member1)
+    prompter.add_quit()
+
+    try:
+        for typed, expected in ((" 1", member0), ("2 ", member1),
+                                ("02", member1), (" q ", 'q')):
+            ib_database_sync.raw_input = lambda: typed
+            assert prompter.prompt() == expected
+    finally:
+        del ib_database_sync.raw_input
+
+def test_find_duplicates():
+    members = [_get_fake_member(HashFriendlyMember) for _ in range(3)]
+    members[1].first_name = "Someone else"
+    members[2].email_address = "another@gmail.com"
+
+    duplicates = find_duplicates(members, ['email_address'])
+    assert len(duplicates) == 1
+    assert duplicates[0] == members[:2]
+
+    assert find_duplicates(members, None) == []
+
+def test_find_duplicates_across():
+    def member(email, first_name, source_name):
+        m = _get_fake_member(HashFriendlyMember)
+        m.email_address = email
+        m.first_name = first_name
+        m.source_name = source_name
+        m._dirty = False
+        return m
+
+    an_members = [member("same@a.com",     "Same",   "ActionNetwork"),
+                  member("conflict@a.com", "Before", "ActionNetwork"),
+                  member("an-only@a.com",  "Only",   "ActionNetwork")]
+    at_members = [member("same@a.com",     "Same",   "AirTable"),
+                  member("conflict@a.com", "After",  "AirTable"),
+                  member("at-only@a.com",  "Only",   "AirTable"),
+                  member("tossed@a.com",   "Gone",   "AirTable")]
+    an_tossed  = [member("tossed@a.com",   "Gone",   "ActionNetwork")]
+
+    merge_conflicts, needs_sync, _ = find_duplicates_across(
+            an_members, at_members, an_tossed, ['email_address'])
+
+    assert len(merge_conflicts) == 1
+    conflicted = merge_conflicts[0].members
+    assert sorted(m.first_name for m in conflicted) == ["After", "Before"]
+
+    synced = sorted((m.email_address, m.source_name) for m in needs_sync)
+    assert synced == [("an-only@a.com", "ActionNetwork"),
+                      ("at-only@a.com", "AirTable")]
+
+    # Dirty members were already handled by an earlier resolution
+    an_members[2]._dirty = True
+    _, needs_sync, _ = find_duplicates_across(
+            an_members, at_members, an_tossed, ['email_address'], skip_dirty=True)
+    synced = sorted((m.email_address, m.source_name) for m in needs_sync)
+    assert synced == [("at-only@a.com", "AirTable")]
+
+def test_missing_field_resolver():
+    resolver = MissingFieldResolver()
+    equality_fields = ['first_name', 'last_name', 'email_address', 'zip_code']
+
+    member0 = _get_fake_member()
+    member1 = _get_fake_member()
+    member1.zip_code = None
+    member1._dirty = False
+    assert resolver.resolve([member0, member1], equality_fields)
+    assert member1.zip_code == member0.zip_code
+    assert member1.dirty
+    assert not member0.dirty
+
+    member0 = _get_fake_member()
+    member1 = _get_fake_member()
+    member1.last_name = "Someone else"
+    member1._dirty = False
+    assert not resolver.resolve([member0, member1], equality_fields)
+    assert not member0.dirty
+    assert not member1.dirty
+
+def _get_fake_member(member_class=Member):
+    return member_class(
             email_address = "nonexistent@gmail.com",
             last_edit     = 0,
             first_name    = "Armin's",